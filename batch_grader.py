@@ -1,14 +1,28 @@
 import os
 import glob
 import re
-import pandas as pd
+import csv
+import json
+import time
+import random
+import base64
+import argparse
+import tempfile
+import threading
+import hashlib
+import sqlite3
+import multiprocessing
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 import fitz  # PyMuPDF
 import cv2
 import numpy as np
 from google import genai
-from google.genai import types
+from google.genai import types, errors
 from dotenv import load_dotenv
-from PIL import Image
+from pydantic import BaseModel, Field
 
 # Load environment variables
 load_dotenv()
@@ -20,6 +34,32 @@ if not API_KEY:
 # Configuration
 INPUT_DIR = './student_submissions'
 OUTPUT_FILE = 'grades.csv'
+CSV_FIELDS = ["Filename", "Student ID", "Student Name", "Score", "Flagged", "Flag Reason", "Feedback"]
+MODEL = "gemini-2.5-flash"
+MAX_WORKERS = 8  # PDFs graded concurrently (mostly waiting on Gemini)
+RENDER_WORKERS = min(os.cpu_count() or 1, 4)  # Processes rasterizing pages
+# Render pools are created from grading threads, and forking while other threads hold
+# locks (HTTP calls, OpenCV) can deadlock the child, so workers are always spawned fresh
+RENDER_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+# Page images: QR detection needs 300 DPI, Gemini reads 150 DPI JPEGs just as well
+QR_DPI = 300
+LLM_DPI = 150
+LLM_MAX_SIDE = 1600
+JPEG_QUALITY = 85
+
+# Gemini rate limits: cap in-flight calls and retry 429/5xx with exponential backoff
+MAX_CONCURRENT_REQUESTS = 4
+MAX_RETRIES = 5
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# On-disk cache of AI results, so reruns don't re-bill unchanged PDFs.
+# Keys cover MODEL, GRADER_PROMPT and the GradeResult schema too, so changing any of them regrades everything.
+CACHE_PATH = '.grader_cache.sqlite'
+
+# Batch API polling
+BATCH_POLL_SECONDS = 30
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
 
 # Grading Rubric System Prompt
 GRADER_PROMPT = r"""
@@ -41,108 +81,518 @@ Your goal is to evaluate the student's work based on the provided images of thei
 4. **Plagiarism/AI Check:** 
     - Flag if the text sounds overly robotic, uses advanced vocabulary not typical for high schoolers, or contains "AI hallucinations" (nonsense phrases).
     - Flag if the data matches the "randomized seed" data exactly (if known, otherwise ignore).
-
-**Output Format:**
-Return ONLY a valid JSON object with the following structure (no markdown formatting):
-{
-  "student_name_detected": "Name Found",
-  "sid_detected": "######",
-  "score": 0-100,
-  "feedback": "Brief summary of feedback...",
-  "plagiarism_flag": true/false,
-  "plagiarism_reason": "Explanation if flagged..."
-}
 """
 
-def extract_images_from_pdf(pdf_path):
-    """Converts PDF pages to Opencv format images. Uses 300 DPI for QR reliability."""
-    doc = fitz.open(pdf_path)
-    images = []
-    for page in doc:
-        # Boost DPI to 300 to make QR codes much clearer for CV detectors
-        pix = page.get_pixmap(dpi=300)
-        img_data = pix.tobytes("ppm")
-        # Convert to numpy array for OpenCV
-        nparr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        images.append(img)
-    return images
+class GradeResult(BaseModel):
+    """Shape of Gemini's grading reply, enforced through the API's structured output."""
+    student_name_detected: str = Field(description="Student Name from the Name field on page 1")
+    sid_detected: str = Field(description="6-digit number after 'SID:', or 'N/A' if not found")
+    score: int = Field(description="Score from 0 to 100")
+    feedback: str = Field(description="Brief summary of feedback")
+    plagiarism_flag: bool
+    plagiarism_reason: str = Field(description="Explanation if flagged, otherwise empty")
+
+_print_lock = threading.Lock()
+
+def log(message):
+    """Thread-safe print, so output from concurrently graded PDFs doesn't interleave mid-line."""
+    with _print_lock:
+        print(message)
+
+_RENDER_POOL = None
+_RENDER_POOL_LOCK = threading.Lock()
+
+def _get_render_pool():
+    """Returns the process pool shared by every PDF, creating it on first use."""
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL is None:
+            _RENDER_POOL = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=RENDER_MP_CONTEXT)
+    return _RENDER_POOL
+
+def _reset_render_pool(broken_pool):
+    """Drops a broken render pool so the next _get_render_pool() call starts a fresh one."""
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        # Another thread may already have replaced it
+        if _RENDER_POOL is broken_pool:
+            _RENDER_POOL = None
+    broken_pool.shutdown(wait=False)
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+def _get_client():
+    """Returns the shared Gemini client, creating it on first use. The client is thread-safe."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = genai.Client(api_key=API_KEY)
+    return _CLIENT
+
+_request_slots = threading.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+def _generate_with_retry(client, filename, **kwargs):
+    """Calls generate_content, retrying rate limits and server errors with backoff plus jitter.
+    filename labels the retry log lines."""
+    for attempt in range(MAX_RETRIES):
+        try:
+            with _request_slots:
+                return client.models.generate_content(**kwargs)
+        except errors.APIError as e:
+            if e.code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRIES - 1:
+                raise
+            delay = 2 ** attempt + random.random()
+            log(f"  [{filename}] Gemini returned {e.code}, retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+def _render_page(pdf_path, page_index, renders):
+    """Renders one PDF page once per (dpi, gray) in renders, as (samples, height, width, channels) each.
+    Runs in a worker process, so it opens its own document; every render reuses the parsed page."""
+    with fitz.open(pdf_path) as doc:
+        page = doc[page_index]
+        rasters = []
+        for dpi, gray in renders:
+            # No alpha channel, and 1 byte/pixel instead of 3 when only grayscale is needed
+            pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY if gray else fitz.csRGB, alpha=False)
+            rasters.append((pix.samples, pix.height, pix.width, pix.n))
+        return rasters
+
+def _to_image(raster):
+    """Wraps rendered samples as a numpy image: (height, width) for gray, (height, width, 3) for RGB."""
+    samples, height, width, channels = raster
+    # Wrap the raw samples directly; no need to encode and re-decode an image file
+    img = np.frombuffer(samples, dtype=np.uint8)
+    if channels == 1:
+        return img.reshape(height, width)
+    return img.reshape(height, width, channels)
+
+def extract_images(pdf_path, for_llm=True):
+    """Converts a PDF to page images in one pass. Returns (qr_images, llm_images):
+    - qr_images: page 1 at 300 DPI in grayscale, sharp enough for the CV detectors.
+      The SID QR is only ever printed on page 1, so later pages aren't rendered at 300 DPI.
+    - llm_images: every page at 150 DPI in RGB. Plenty for Gemini to read, at a quarter of the pixels.
+      Empty when for_llm is False (e.g. the AI result is already cached), so only page 1 is rendered.
+    """
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+
+    if not page_count:
+        # Nothing to render; callers report "Could not extract images"
+        renders = []
+    elif for_llm:
+        # Page 1 is rendered for both uses from the same open document; other pages only for Gemini
+        renders = [[(QR_DPI, True), (LLM_DPI, False)]] + [[(LLM_DPI, False)]] * (page_count - 1)
+    else:
+        renders = [[(QR_DPI, True)]]
+
+    # Rasterizing is CPU-bound, so pages are rendered in parallel processes
+    # (PyMuPDF documents can't be shared across processes). map() keeps page order.
+    # The pool is shared so concurrently graded PDFs don't each spawn their own.
+    render = partial(_render_page, pdf_path)
+    pool = _get_render_pool()
+    try:
+        pages = list(pool.map(render, range(len(renders)), renders))
+    except BrokenProcessPool:
+        # A worker died (MuPDF crash, out of memory) and took the pool with it, failing
+        # every PDF that was rendering on it. Replace the shared pool for later PDFs and
+        # retry this one on a private pool: if this PDF is the culprit it only breaks its
+        # own pool again, instead of taking down the PDFs on the replacement.
+        _reset_render_pool(pool)
+        with ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=RENDER_MP_CONTEXT) as own_pool:
+            pages = list(own_pool.map(render, range(len(renders)), renders))
+
+    qr_images = []
+    llm_images = []
+    for page_index, rasters in enumerate(pages):
+        if page_index == 0:
+            qr_images.append(_to_image(rasters[0]))
+        if for_llm:
+            llm_images.append(_to_image(rasters[-1]))
+    return qr_images, llm_images
+
+def _decode_qr_codes(detect, image):
+    """Returns the non-empty strings of every QR code decoded in the image."""
+    ok, decoded_infos, points, _ = detect.detectAndDecodeMulti(image)
+    if not ok:
+        return []
+    return [info for info in decoded_infos if info]
 
 def scan_qr_for_sid(image):
-    """Scans an image for a QR code containing 'SID:' with multiple preprocessing attempts."""
+    """Scans a grayscale or BGR image for a QR code containing 'SID:' with multiple preprocessing attempts."""
     detect = cv2.QRCodeDetector()
+
+    # Work in grayscale throughout; the detector would otherwise convert on every attempt.
+    # Images rendered straight to grayscale skip the conversion entirely.
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     
-    # Attempt 1: Raw image
-    value, points, straight_qrcode = detect.detectAndDecode(image)
+    # Attempt 1: Raw image (all QR codes on it, in case the page carries more than one)
+    values = _decode_qr_codes(detect, gray)
     
-    # Attempt 2: Grayscale + Threshold (Helps with glare/low contrast)
-    if not value:
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        _, thresh = cv2.threshold(gray, 150, 255, cv2.THRESH_BINARY)
-        value, points, straight_qrcode = detect.detectAndDecode(thresh)
-
-    if value:
-        # Check for SID format
+    # Attempt 2: Otsu Threshold (Helps with glare/low contrast)
+    # Only runs when the raw pass found nothing. Otsu picks the cutoff per scan,
+    # so bright and dim scans both binarize cleanly.
+    if not values:
+        _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        values = _decode_qr_codes(detect, thresh)
+
+        # Attempt 3: Inverted colors (light code on a dark background)
+        if not values:
+            values = _decode_qr_codes(detect, 255 - thresh)
+
+        # Attempt 4: Adaptive threshold (Uneven lighting across the page).
+        # Block size 83 matches OpenCV's own QR decoder.
+        if not values:
+            adaptive = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 83, 2)
+            values = _decode_qr_codes(detect, adaptive)
+
+    # Check for SID format
+    for value in values:
         match = re.search(r"SID:(\d+)", value)
         if match:
             return match.group(1) # Return just the digits
-        return value # Return raw value if it doesn't match expected pattern
+
+    if values:
+        return values[0] # Return raw value if none match the expected pattern
         
     return None
 
-def grade_submission(images):
-    """Sends images to Gemini for grading using the new google-genai SDK."""
+def failed_result():
+    """Placeholder result used when the AI could not grade a submission."""
+    return {
+        "student_name_detected": "Error",
+        "sid_detected": "Error",
+        "score": 0,
+        "feedback": f"AI Processing Failed. Check terminal for available models.",
+        "plagiarism_flag": False
+    }
+
+def _is_blank(rgb_img):
+    """True for near-empty pages (e.g. blank backs of printed sheets): almost all white, almost no variation."""
+    gray = cv2.cvtColor(rgb_img, cv2.COLOR_RGB2GRAY)
+    return gray.mean() > 245 and gray.std() < 8
+
+def drop_blank_pages(images, filename):
+    """Removes blank pages before upload, since every image costs Gemini tokens."""
+    kept = [img for img in images if not _is_blank(img)]
+    if len(kept) < len(images):
+        log(f"  [{filename}] Skipped {len(images) - len(kept)} blank page(s)")
+    # An all-blank submission is still sent, so the AI can report it as empty
+    return kept or images
+
+def encode_for_llm(rgb_img):
+    """Downscales an RGB page image and encodes it as JPEG, cutting upload size several-fold."""
+    height, width = rgb_img.shape[:2]
+    scale = LLM_MAX_SIDE / max(height, width)
+    if scale < 1:
+        rgb_img = cv2.resize(rgb_img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+    # Encode straight from the array (OpenCV wants BGR order) instead of round-tripping through PIL
+    ok, buf = cv2.imencode(".jpg", cv2.cvtColor(rgb_img, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise ValueError("Could not encode page image as JPEG")
+    return buf.tobytes()
+
+def grade_submission(images, filename):
+    """Sends images to Gemini for grading using the new google-genai SDK. filename labels log lines."""
     try:
-        # Initialize Client
-        client = genai.Client(api_key=API_KEY)
+        client = _get_client()
         
-        # Prepare content: Prompt + List of PIL Images
+        # Prepare content: Prompt + downscaled JPEG page images
         content_parts = [GRADER_PROMPT]
         
-        for cv_img in images:
-            # Convert to RGB for PIL/Gemini
-            color_converted = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-            pil_img = Image.fromarray(color_converted)
-            content_parts.append(pil_img)
+        for page_img in drop_blank_pages(images, filename):
+            content_parts.append(types.Part.from_bytes(data=encode_for_llm(page_img), mime_type="image/jpeg"))
 
         # Call the API. Using gemini-2.5-flash as it's the current flagship
-        target_model = "gemini-2.5-flash" 
-        
-        response = client.models.generate_content(
-            model=target_model, 
-            contents=content_parts
+        # The reply is constrained to GradeResult JSON, so no prompt instructions or fence-stripping needed
+        response = _generate_with_retry(
+            client,
+            filename,
+            model=MODEL, 
+            contents=content_parts,
+            config=types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=GradeResult
+            )
         )
+        if response.parsed is None:
+            raise ValueError(f"Reply did not match the grade schema: {response.text}")
         
-        # Clean response text
-        text = response.text
-        if text.startswith('```json'):
-            text = text.replace('```json', '').replace('```', '')
-        text = text.strip()
-        
-        # Parse JSON
-        import json
-        return json.loads(text)
+        return response.parsed.model_dump()
 
     except Exception as e:
-        print(f"  AI Error: {e}")
+        log(f"  [{filename}] AI Error: {e}")
         # Debugging: List models if we get a 404
         if "404" in str(e) or "not found" in str(e).lower():
             try:
-                print("  --- Listing Available Models for this Key ---")
-                client = genai.Client(api_key=API_KEY)
+                log("  --- Listing Available Models for this Key ---")
+                client = _get_client()
                 for m in client.models.list():
-                    print(f"  > {m.name}")
+                    log(f"  > {m.name}")
             except:
                 pass
-        return {
-            "student_name_detected": "Error",
-            "sid_detected": "Error",
-            "score": 0,
-            "feedback": f"AI Processing Failed. Check terminal for available models.",
-            "plagiarism_flag": False
+        return failed_result()
+
+def cache_key(pdf_path):
+    """Cache key for a PDF's AI result: SHA-1 of MODEL, GRADER_PROMPT, the GradeResult schema
+    (its field descriptions are part of the instructions) and the PDF's bytes, so editing
+    the rubric, the output schema or the model can never return an old grade."""
+    h = hashlib.sha1()
+    h.update(MODEL.encode("utf-8") + b"\0")
+    h.update(GRADER_PROMPT.encode("utf-8") + b"\0")
+    h.update(json.dumps(GradeResult.model_json_schema(), sort_keys=True).encode("utf-8") + b"\0")
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _cache_connect():
+    """Opens the result cache, creating its table on first use. One connection per call keeps threads safe."""
+    conn = sqlite3.connect(CACHE_PATH, timeout=30)
+    conn.execute("CREATE TABLE IF NOT EXISTS cached_results (cache_key TEXT PRIMARY KEY, result TEXT NOT NULL)")
+    return conn
+
+def cache_get(key):
+    """Returns the cached AI result for a cache key, or None."""
+    with closing(_cache_connect()) as conn:
+        row = conn.execute("SELECT result FROM cached_results WHERE cache_key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def cache_put(key, json_str):
+    """Stores an AI result (as a JSON string) under a cache key."""
+    with closing(_cache_connect()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO cached_results VALUES (?, ?)", (key, json_str))
+
+def cache_ai_result(key, ai_result):
+    """Caches a successful AI result. Failures aren't cached, so they're retried on the next run."""
+    if ai_result != failed_result():
+        cache_put(key, json.dumps(ai_result))
+
+def build_request(images, filename):
+    """Builds one Batch API request (prompt + page images) for a single submission."""
+    parts = [{"text": GRADER_PROMPT}]
+    for page_img in drop_blank_pages(images, filename):
+        # Batch requests travel as JSONL, so images are inlined as base64 JPEG
+        parts.append({
+            "inline_data": {
+                "mime_type": "image/jpeg",
+                "data": base64.b64encode(encode_for_llm(page_img)).decode("ascii")
+            }
+        })
+    return {
+        "contents": [{"role": "user", "parts": parts}],
+        "generation_config": {
+            "response_mime_type": "application/json",
+            "response_json_schema": GradeResult.model_json_schema()
         }
+    }
+
+def submit_batch(jsonl_path):
+    """Submits a JSONL file of {"key", "request"} lines as one Gemini Batch API job.
+    Returns {key: parsed result}; raises RuntimeError if the job doesn't succeed."""
+    client = _get_client()
+
+    # 1. Upload the requests file
+    uploaded = client.files.upload(
+        file=jsonl_path,
+        config=types.UploadFileConfig(display_name="lab-grader-batch", mime_type="jsonl")
+    )
+
+    # 2. Create the job and poll until it finishes
+    job = client.batches.create(
+        model=MODEL,
+        src=uploaded.name,
+        config={"display_name": "lab-grader-batch"}
+    )
+    log(f"  Batch job created: {job.name}")
+    while job.state.name not in BATCH_DONE_STATES:
+        time.sleep(BATCH_POLL_SECONDS)
+        job = client.batches.get(name=job.name)
+        log(f"  Batch state: {job.state.name}")
+
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch job {job.name} ended in {job.state.name}")
+
+    # 3. Download the results file and map key -> parsed JSON
+    results = {}
+    raw = client.files.download(file=job.dest.file_name)
+    for line in raw.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        key = item.get("key")
+        try:
+            text = item["response"]["candidates"][0]["content"]["parts"][0]["text"]
+            results[key] = GradeResult.model_validate_json(text).model_dump()
+        except (KeyError, IndexError, ValueError) as e:
+            log(f"  AI Error ({key}): {item.get('error', e)}")
+            results[key] = failed_result()
+    return results
+
+def detect_sid(images):
+    """Returns the SID from the QR code at the top of page 1, or None."""
+    if not images:
+        return None
+    # The rubric puts the SID QR at the top of page 1; scanning just the top quarter
+    # keeps the grayscale/threshold passes small
+    first_page = images[0]
+    return scan_qr_for_sid(first_page[: first_page.shape[0] // 4, :])
+
+def build_row(filename, detected_sid, ai_result):
+    """Merges the CV SID with the AI result into one CSV row (AI SID as fallback)."""
+    final_sid = detected_sid
+    if not final_sid:
+        ai_sid = ai_result.get('sid_detected')
+        if ai_sid and ai_sid != "N/A" and ai_sid != "Error":
+            final_sid = ai_sid
+            log(f"  [{filename}] AI Fallback Found SID: {final_sid}")
+        else:
+            final_sid = "N/A"
+
+    return {
+        "Filename": filename,
+        "Student ID": final_sid,
+        "Student Name": ai_result.get('student_name_detected', 'Unknown'),
+        "Score": ai_result.get('score', 0),
+        "Flagged": "YES" if ai_result.get('plagiarism_flag') else "No",
+        "Flag Reason": ai_result.get('plagiarism_reason', ''),
+        "Feedback": ai_result.get('feedback', '')
+    }
+
+def _prepare_pdf(pdf_path, filename, log_fn=log):
+    """Cache lookup, rendering and QR scan for one PDF, shared by every grading path.
+    Returns (key, cached_result, detected_sid, llm_images). On a cache hit only page 1 is
+    rendered (for the QR scan) and llm_images is empty. Raises ValueError if nothing renders."""
+    key = cache_key(pdf_path)
+    cached = cache_get(key)
+    qr_images, llm_images = extract_images(pdf_path, for_llm=cached is None)
+    if not qr_images:
+        raise ValueError("Could not extract images.")
+
+    detected_sid = detect_sid(qr_images)
+    if detected_sid:
+        log_fn(f"  [{filename}] CV QR Found SID: {detected_sid}")
+    return key, cached, detected_sid, llm_images
+
+def analyze_pdf(pdf_path, filename, log_fn=log):
+    """QR-scans and AI-grades one PDF, skipping Gemini when the result is cached.
+    Returns (detected_sid, ai_result); detected_sid is None when no QR code was read.
+    log_fn receives the per-PDF progress lines (the GUI passes its own log)."""
+    key, ai_result, detected_sid, llm_images = _prepare_pdf(pdf_path, filename, log_fn)
+    if ai_result is not None:
+        log_fn(f"  [{filename}] Using cached AI result")
+    else:
+        log_fn(f"  [{filename}] Analyzing with Gemini...")
+        ai_result = grade_submission(llm_images, filename)
+        cache_ai_result(key, ai_result)
+    return detected_sid, ai_result
+
+def process_one(pdf_path):
+    """Extracts, QR-scans and grades one PDF. Returns its CSV row, or None if it failed."""
+    filename = os.path.basename(pdf_path)
+    log(f"\nProcessing: {filename}")
+
+    try:
+        # 1-4. Cache lookup, Images, QR Code via Computer Vision, and AI grading
+        detected_sid, ai_result = analyze_pdf(pdf_path, filename)
+
+        # 5. Final SID Logic (AI Fallback) + Compile Row
+        row = build_row(filename, detected_sid, ai_result)
+        log(f"  [{filename}] Score: {row['Score']} | SID: {row['Student ID']}")
+        return row
+
+    except Exception as e:
+        log(f"  [{filename}] Critical Error processing file: {e}")
+        return None
+
+def grade_all(pdf_files):
+    """Grades PDFs concurrently, yielding each row as soon as its PDF finishes."""
+    # PDFs are graded concurrently so rasterizing one overlaps with waiting on Gemini for others
+    ex = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        futures = [ex.submit(process_one, pdf_path) for pdf_path in pdf_files]
+        for future in as_completed(futures):
+            row = future.result()
+            if row:
+                yield row
+    except BaseException:
+        # Ctrl+C, or the caller stopped early (e.g. a CSV write failed): drop queued PDFs
+        # instead of rendering and billing every one of them before exiting
+        ex.shutdown(wait=False, cancel_futures=True)
+        raise
+    ex.shutdown()
+
+def grade_all_batch(pdf_files):
+    """Grades every PDF through a single Batch API job instead of one call per file. Yields rows."""
+    # 1. Extract images and scan QR codes locally; cached PDFs skip the batch.
+    # Each request is written to the JSONL as soon as it's built, so the
+    # base64 page images of the whole class are never held in memory at once.
+    submitted = []
+    detected = {}
+    keys = {}
+    ai_results = {}
+    jsonl = tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8")
+    jsonl_path = jsonl.name
+    try:
+        with jsonl:
+            for pdf_path in pdf_files:
+                filename = os.path.basename(pdf_path)
+                log(f"\nPreparing: {filename}")
+                try:
+                    key, cached, detected_sid, llm_images = _prepare_pdf(pdf_path, filename)
+                    keys[filename] = key
+                    detected[filename] = detected_sid
+                    if cached is not None:
+                        log(f"  [{filename}] Using cached AI result")
+                        ai_results[filename] = cached
+                        continue
+                    request = build_request(llm_images, filename)
+                    jsonl.write(json.dumps({"key": filename, "request": request}) + "\n")
+                    submitted.append(filename)
+                except Exception as e:
+                    log(f"  Critical Error processing file: {e}")
+
+        # 2. One batch job for all uncached submissions
+        if submitted:
+            log(f"\nSubmitting {len(submitted)} submissions to the Gemini Batch API...")
+            try:
+                batch_results = submit_batch(jsonl_path)
+            except Exception as e:
+                # Keep the CV SIDs and cached grades; the submitted PDFs get failure rows
+                log(f"  Batch Error: {e}")
+                batch_results = {filename: failed_result() for filename in submitted}
+            for filename, ai_result in batch_results.items():
+                if filename in keys:
+                    cache_ai_result(keys[filename], ai_result)
+            ai_results.update(batch_results)
+    finally:
+        os.remove(jsonl_path)
+
+    # 3. Merge AI results with CV SIDs
+    for filename, detected_sid in detected.items():
+        log(f"\nResult: {filename}")
+        row = build_row(filename, detected_sid, ai_results.get(filename, failed_result()))
+        log(f"  Score: {row['Score']} | SID: {row['Student ID']}")
+        yield row
+
+def read_graded_rows(csv_path):
+    """Returns the rows of a grades CSV whose AI grading succeeded.
+    Rows written from failed_result() are left out, so --resume retries those PDFs."""
+    if not os.path.exists(csv_path):
+        return []
+    failed_name = failed_result()["student_name_detected"]
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        return [row for row in csv.DictReader(f) if row.get("Student Name") != failed_name]
 
 def main():
+    parser = argparse.ArgumentParser(description="Bulk-grade lab report PDFs with Gemini.")
+    parser.add_argument("--batch", action="store_true",
+                        help="Submit all PDFs as one Gemini Batch API job (half the cost, results arrive later).")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"Keep PDFs already graded in {OUTPUT_FILE} and only grade the rest (including failed ones).")
+    args = parser.parse_args()
+
     if not os.path.exists(INPUT_DIR):
         print(f"Creating input directory: {INPUT_DIR}")
         os.makedirs(INPUT_DIR)
@@ -154,62 +604,30 @@ def main():
         print(f"No PDF files found in {INPUT_DIR}")
         return
 
-    results = []
-
     print(f"Found {len(pdf_files)} submissions. Processing...")
 
-    for pdf_path in pdf_files:
-        filename = os.path.basename(pdf_path)
-        print(f"\nProcessing: {filename}")
-        
-        try:
-            # 1. Convert to Images (300 DPI)
-            images = extract_images_from_pdf(pdf_path)
-            if not images:
-                print("  Error: Could not extract images.")
-                continue
-
-            # 2. Scan QR Code via Computer Vision
-            detected_sid = None
-            for img in images:
-                detected_sid = scan_qr_for_sid(img)
-                if detected_sid:
-                    print(f"  CV QR Found SID: {detected_sid}")
-                    break
-            
-            # 3. Grade and Extract SID with AI
-            print("  Analyzing with Gemini...")
-            ai_result = grade_submission(images)
-            
-            # 4. Final SID Logic (AI Fallback)
-            final_sid = detected_sid
-            if not final_sid:
-                ai_sid = ai_result.get('sid_detected')
-                if ai_sid and ai_sid != "N/A" and ai_sid != "Error":
-                    final_sid = ai_sid
-                    print(f"  AI Fallback Found SID: {final_sid}")
-                else:
-                    final_sid = "N/A"
-
-            # 5. Compile Row
-            row = {
-                "Filename": filename,
-                "Student ID": final_sid,
-                "Student Name": ai_result.get('student_name_detected', 'Unknown'),
-                "Score": ai_result.get('score', 0),
-                "Flagged": "YES" if ai_result.get('plagiarism_flag') else "No",
-                "Flag Reason": ai_result.get('plagiarism_reason', ''),
-                "Feedback": ai_result.get('feedback', '')
-            }
-            results.append(row)
-            print(f"  Score: {row['Score']} | SID: {row['Student ID']}")
+    graded = read_graded_rows(OUTPUT_FILE) if args.resume else []
+    skip = {row["Filename"] for row in graded}
+    if skip:
+        pdf_files = [p for p in pdf_files if os.path.basename(p) not in skip]
+        print(f"Resuming: {len(skip)} already graded, {len(pdf_files)} left.")
+
+    # Rows are written as each PDF finishes, so a crash keeps everything graded so far
+    with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as fp:
+        writer = csv.DictWriter(fp, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        # On --resume, successful rows carry over; failed rows are dropped so their
+        # regraded rows don't end up next to them as duplicates
+        writer.writerows(graded)
+        fp.flush()
 
-        except Exception as e:
-            print(f"  Critical Error processing file: {e}")
+        rows = grade_all_batch(pdf_files) if args.batch else grade_all(pdf_files)
+        # closing() stops the generator (and its queued work) if a write fails
+        with closing(rows):
+            for row in rows:
+                writer.writerow(row)
+                fp.flush()
 
-    # Export
-    df = pd.DataFrame(results)
-    df.to_csv(OUTPUT_FILE, index=False)
     print(f"\nDone! Grades saved to {OUTPUT_FILE}")
 
 if __name__ == "__main__":
@@ -5,8 +5,9 @@ import threading
 import os
 import sys
 import glob
-import pandas as pd
+import csv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Import the logic, not the execution
 # Ensure batch_grader.py has `if __name__ == "__main__":`
@@ -19,6 +20,8 @@ except ImportError:
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
 
+CSV_FIELDS = ["Filename", "Student ID (QR)", "Student Name (AI)", "Score", "Flagged", "Flag Reason", "Feedback"]
+
 class GraderApp(ctk.CTk):
     def __init__(self):
         super().__init__()
@@ -28,6 +31,7 @@ class GraderApp(ctk.CTk):
 
         self.input_dir = os.path.join(os.getcwd(), "student_submissions")
         self.is_running = False
+        self.log_lock = threading.Lock()  # Worker threads log concurrently
         
         # --- UI Layout ---
         self.grid_columnconfigure(0, weight=1)
@@ -72,10 +76,11 @@ class GraderApp(ctk.CTk):
         self.label_status.grid(row=4, column=0, pady=(0, 10))
 
     def log(self, message):
-        self.log_box.configure(state="normal")
-        self.log_box.insert("end", f"[{datetime.now().strftime('%H:%M:%S')}] {message}\n")
-        self.log_box.see("end")
-        self.log_box.configure(state="disabled")
+        with self.log_lock:
+            self.log_box.configure(state="normal")
+            self.log_box.insert("end", f"[{datetime.now().strftime('%H:%M:%S')}] {message}\n")
+            self.log_box.see("end")
+            self.log_box.configure(state="disabled")
 
     def browse_folder(self):
         folder = filedialog.askdirectory(initialdir=self.input_dir)
@@ -118,53 +123,33 @@ class GraderApp(ctk.CTk):
             
             self.log(f"Found {total} PDFs. Initializing Gemini...")
 
-            results = []
-            
-            for i, pdf_path in enumerate(pdf_files):
-                filename = os.path.basename(pdf_path)
-                self.log(f"Processing ({i+1}/{total}): {filename}...")
-                self.label_status.configure(text=f"Processing {filename}...")
-                
-                try:
-                    # REUSE LOGIC FROM BATCH_GRADER.PY
-                    images = batch_grader.extract_images_from_pdf(pdf_path)
-                    
-                    sid_raw = "N/A"
-                    for img in images:
-                        found_sid = batch_grader.scan_qr_for_sid(img)
-                        if found_sid:
-                            self.log(f"  > QR Code Detected: {found_sid}")
-                            sid_raw = found_sid
-                            break
-                    
-                    self.log("  > Asking Gemini to grade...")
-                    ai_result = batch_grader.grade_submission(images)
-                    
-                    score = ai_result.get('score', 0)
-                    flag = "YES" if ai_result.get('plagiarism_flag') else "No"
-                    self.log(f"  > Score: {score} | Plagiarism Flag: {flag}")
-
-                    row = {
-                        "Filename": filename,
-                        "Student ID (QR)": sid_raw,
-                        "Student Name (AI)": ai_result.get('student_name_detected', 'Unknown'),
-                        "Score": score,
-                        "Flagged": flag,
-                        "Flag Reason": ai_result.get('plagiarism_reason', ''),
-                        "Feedback": ai_result.get('feedback', '')
-                    }
-                    results.append(row)
-
-                except Exception as e:
-                    self.log(f"  > Error: {e}")
-
-                # Update Progress
-                self.progress_bar.set((i + 1) / total)
-
-            # Export
             output_file = os.path.join(self.input_dir, "grades_gui_export.csv")
-            df = pd.DataFrame(results)
-            df.to_csv(output_file, index=False)
+            done = 0
+
+            # Export: each row is written as soon as its PDF finishes, so a crash keeps finished grades
+            with open(output_file, "w", newline="", encoding="utf-8") as fp:
+                writer = csv.DictWriter(fp, fieldnames=CSV_FIELDS)
+                writer.writeheader()
+
+                # Grade several PDFs at once; the progress bar advances as each one finishes
+                ex = ThreadPoolExecutor(max_workers=batch_grader.MAX_WORKERS)
+                try:
+                    futures = [ex.submit(self.process_file, pdf_path) for pdf_path in pdf_files]
+                    for future in as_completed(futures):
+                        row = future.result()
+                        if row:
+                            writer.writerow(row)
+                            fp.flush()
+
+                        # Update Progress
+                        done += 1
+                        self.progress_bar.set(done / total)
+                        self.label_status.configure(text=f"Processed {done}/{total}")
+                except BaseException:
+                    # Don't keep grading (and billing) queued PDFs after a failure
+                    ex.shutdown(wait=False, cancel_futures=True)
+                    raise
+                ex.shutdown()
             
             self.log(f"--------------------------------------------------")
             self.log(f"DONE! CSV saved to: {output_file}")
@@ -179,6 +164,34 @@ class GraderApp(ctk.CTk):
         finally:
             self.finish_run()
 
+    def process_file(self, pdf_path):
+        """Grades one PDF on a worker thread. Returns its CSV row, or None on error."""
+        filename = os.path.basename(pdf_path)
+        self.log(f"Processing: {filename}...")
+
+        try:
+            # REUSE LOGIC FROM BATCH_GRADER.PY (cache lookup, rendering, QR scan, Gemini)
+            detected_sid, ai_result = batch_grader.analyze_pdf(pdf_path, filename, log_fn=self.log)
+            sid_raw = detected_sid or "N/A"
+            
+            score = ai_result.get('score', 0)
+            flag = "YES" if ai_result.get('plagiarism_flag') else "No"
+            self.log(f"  > [{filename}] Score: {score} | Plagiarism Flag: {flag}")
+
+            return {
+                "Filename": filename,
+                "Student ID (QR)": sid_raw,
+                "Student Name (AI)": ai_result.get('student_name_detected', 'Unknown'),
+                "Score": score,
+                "Flagged": flag,
+                "Flag Reason": ai_result.get('plagiarism_reason', ''),
+                "Feedback": ai_result.get('feedback', '')
+            }
+
+        except Exception as e:
+            self.log(f"  > [{filename}] Error: {e}")
+            return None
+
     def finish_run(self):
         self.is_running = False
         self.btn_run.configure(state="normal", text="▶ START GRADING")
@@ -2,7 +2,10 @@
 ## @author AgustinVallejo
 
 ## This file takes an array of 2d vertices, allegedly sorted randomly, and sorts them by proximity to properly build
-## a polygon. It's not flawless, and it might stall if it's done and finds duplicate vertices.
+## a polygon. It's not flawless: it greedily walks to the nearest vertex not yet added, so very jagged shapes may
+## still come out crossed.
+
+import numpy as np
 
 # Original array of vertices
 vertices = [] # Put here the tuples of vertex coordinates, i.e. ( 0.53, 1.22 )
@@ -10,31 +13,19 @@ vertices = [] # Put here the tuples of vertex coordinates, i.e. ( 0.53, 1.22 )
 # New vertices empty array
 vertices2 = []
 
-c = vertices[0] # First vertex
-
-# Distance function
-dist = lambda a,b: ((a[0] - b[0])**2 + (a[1] - b[1])**2)**.5
-
-count = 0
-
-print("If the following percentage stalls, feel free to interrupt the code.")
-while ( len(vertices2) < len(vertices) ) or ( count > len( vertices ) * 5):
-    if c not in vertices2:
-        print(f"Percentage of vertices added {100*len(vertices2)/len(vertices)}%")
-        # NOTE: If this percentage stalls, feel free to interrupt the code.
-        # There were likely repeated vertices and you can proceed with vertices2
-        vertices2.append(c)
-
-    minim = 100 # Minimum distance, will change
-    ctemp = () # New coordinates to be added
-    for v in vertices:
-        # Check all the vertices for distance
-        if v != c:
-            d = dist(v,c)
-            if d < minim and v not in vertices2:
-                minim = d
-                ctemp = v
-    if ctemp:
-        c = ctemp
-
-    count += 1
\ No newline at end of file
+pts = np.asarray(vertices, dtype=np.float64) # Same vertices as an (N, 2) array, for vectorized distances
+used = np.zeros(len(pts), dtype=bool) # Which vertices are already in vertices2
+
+i = 0 # First vertex
+
+while True:
+    vertices2.append(vertices[i])
+    used[i] = True
+    print(f"Percentage of vertices added {100*len(vertices2)/len(vertices)}%")
+    if used.all():
+        break
+
+    # Squared distance from the current vertex to every vertex; the nearest one is the same without the sqrt
+    d2 = ((pts - pts[i])**2).sum(axis=1)
+    d2[used] = np.inf # Never pick a vertex twice (repeated coordinates are still added once each)
+    i = int(d2.argmin())